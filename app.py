@@ -1,25 +1,68 @@
 import os
+import asyncio
 import base64
+import hashlib
+import json
+import logging
+import random
 import cv2
 import numpy as np
+import torch
 import arxiv
 from openai import OpenAI
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import gradio as gr
-from io import BytesIO
-import pdf2image
+import fitz
 import tempfile
+import threading
 import layoutparser as lp
 from datetime import datetime
 from pdfminer.high_level import extract_text
 from dotenv import load_dotenv
-import time
 import re
 from llm_utils import get_token_len, get_text_before_word
 
 truncate_len = 30000
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# PDFを画像に変換する際の解像度
+PDF_RENDER_DPI = 200
+# レイアウト検出で一度に推論するページ数(VRAMに収まるよう調整する)
+LAYOUT_BATCH_SIZE = 8
+
+# 切り出した画像のJPEG保存設定
+# レイアウト検出は元の解像度で済んでいるため、Geminiへのアップロード量を抑える品質にする
+SEGMENT_JPEG_PARAMS = [
+    int(cv2.IMWRITE_JPEG_QUALITY), 85,
+    int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0,
+    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+]
+
+# 要約・解説のMarkdownと切り出した画像を保存するディレクトリ
+OUTPUT_DIR = "output"
+# 解説のMarkdownから出力ディレクトリの画像を参照できるようにする
+# launchの引数ではなくここで設定し、起動方法によらず配信されるようにする
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+gr.set_static_paths(paths=[OUTPUT_DIR])
+
+# 処理結果のキャッシュを保存するディレクトリ
+CACHE_DIR = "cache"
+
+# Gemini APIへの同時リクエスト数(レート制限に合わせて環境変数で調整する)
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
+# レート制限・一時的なエラー時のリトライ回数
+LLM_MAX_RETRIES = 5
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
 # 環境変数からAPIキーを取得
 google_api_key = os.environ.get("GOOGLEAI_API_KEY")
 if not google_api_key:
@@ -36,6 +79,135 @@ ai_client = genai.GenerativeModel(
 
 local_client = OpenAI(base_url="http://172.19.128.1:1234/v1", api_key="lm-studio")
 
+# arXivのクライアントは接続を使い回すため共有する
+# 1論文ずつ取得するのでpage_sizeは1、間隔はarXiv APIの利用規約に従い3秒にする
+ARXIV_CLIENT = arxiv.Client(page_size=1, delay_seconds=3.0, num_retries=3)
+
+# レイアウト検出モデルは読み込みが重いため、初回利用時に生成して使い回す
+_PUBLAYNET_MODEL = None
+_MFD_MODEL = None
+_MODEL_LOCK = threading.Lock()
+
+# 実行中のバックグラウンドでのファイル書き込み
+_BACKGROUND_TASKS = set()
+
+# 書き込むファイルの権限を決めるためのumask(取得するには一度設定し直す必要がある)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def file_sha256(path: str) -> str:
+    """
+    ファイルの内容のSHA-256ハッシュを計算する関数
+
+    Args:
+        path (str): ハッシュを計算するファイルのパス
+
+    Returns:
+        str: 16進数表記のハッシュ
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_key(*parts: str) -> str:
+    """
+    キャッシュのキーを生成する関数
+
+    Args:
+        *parts (str): キーを構成する文字列
+
+    Returns:
+        str: キャッシュのキー
+    """
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def load_cache(key: str):
+    """
+    キャッシュを読み込む関数
+
+    Args:
+        key (str): キャッシュのキー
+
+    Returns:
+        キャッシュした値。キャッシュがない、または壊れている場合はNone
+    """
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        # 書き込み途中で中断したファイルなどはキャッシュがないものとして扱う
+        logger.warning("Ignore broken cache %s: %s", path, e)
+        return None
+
+
+def save_cache(key: str, value) -> None:
+    """
+    キャッシュを保存する関数
+
+    Args:
+        key (str): キャッシュのキー
+        value: JSONに変換可能な保存する値
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    write_atomic(os.path.join(CACHE_DIR, f"{key}.json"), json.dumps(value, ensure_ascii=False))
+
+
+def write_atomic(path: str, data: str) -> None:
+    """
+    ファイルをアトミックに書き込む関数
+
+    同じディレクトリの一時ファイルに書き込んでから置き換えるため、書き込み途中のファイルが読まれることはない
+
+    Args:
+        path (str): 書き込むファイルのパス
+        data (str): 書き込む内容
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        # mkstempは0600で作成するため、通常のopenと同じくumaskに従う権限にする
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_in_background(path: str, data: str) -> None:
+    """
+    ファイルの書き込みをバックグラウンドで行う関数
+
+    書き込みの完了を待たずに戻るため、結果をすぐに画面へ返せる
+
+    Args:
+        path (str): 書き込むファイルのパス
+        data (str): 書き込む内容
+    """
+    # 書き込み先がないと完了後まで失敗に気付けないため、ディレクトリは先に作成する
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    task = asyncio.create_task(asyncio.to_thread(write_atomic, path, data))
+    # 完了前のタスクがGCで破棄されないよう参照を保持する
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_task_done)
+
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    """
+    バックグラウンドでの書き込みの完了時に呼ばれ、失敗していればログに出力する関数
+
+    Args:
+        task (asyncio.Task): 完了したタスク
+    """
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to write file in background", exc_info=task.exception())
+
 
 def download_paper(arxiv_url: str, save_dir: str) -> str:
     """
@@ -49,7 +221,7 @@ def download_paper(arxiv_url: str, save_dir: str) -> str:
         str: ダウンロードした論文のPDFファイルのパス
     """
     paper_id = arxiv_url.split("/")[-1]
-    paper = next(arxiv.Client().results(arxiv.Search(id_list=[paper_id])))
+    paper = next(ARXIV_CLIENT.results(arxiv.Search(id_list=[paper_id])))
 
     os.makedirs(save_dir, exist_ok=True)
     filename = f"{paper_id}.pdf"
@@ -59,125 +231,281 @@ def download_paper(arxiv_url: str, save_dir: str) -> str:
     return pdf_path, paper.title
 
 
-def extract_figures_and_tables(pdf_path: str, save_dir: str) -> list:
+def get_publaynet_model() -> lp.Detectron2LayoutModel:
+    """
+    図表検出用のレイアウトモデル(PubLayNet)を取得する関数
+
+    Returns:
+        lp.Detectron2LayoutModel: 図表検出用のモデル
+    """
+    global _PUBLAYNET_MODEL
+    with _MODEL_LOCK:
+        if _PUBLAYNET_MODEL is None:
+            _PUBLAYNET_MODEL = lp.Detectron2LayoutModel(
+                "lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config",
+                extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.8],
+                label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"},
+            )
+    return _PUBLAYNET_MODEL
+
+
+def get_mfd_model() -> lp.Detectron2LayoutModel:
+    """
+    数式検出用のレイアウトモデル(MFD)を取得する関数
+
+    Returns:
+        lp.Detectron2LayoutModel: 数式検出用のモデル
+    """
+    global _MFD_MODEL
+    with _MODEL_LOCK:
+        if _MFD_MODEL is None:
+            _MFD_MODEL = lp.Detectron2LayoutModel(
+                "lp://MFD/faster_rcnn_R_50_FPN_3x/config",
+                extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.8],
+                label_map={1: "Equation"},
+            )
+    return _MFD_MODEL
+
+
+def render_pages(pdf_path: str, dpi: int = PDF_RENDER_DPI):
+    """
+    PDFの各ページを画像に変換するジェネレータ
+
+    Args:
+        pdf_path (str): 変換するPDFファイルのパス
+        dpi (int): 変換する際の解像度
+
+    Yields:
+        np.ndarray: BGR形式のページ画像
+    """
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=dpi)
+            image_np = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            # チャンネルの並べ替えはコピーせずビューで行う
+            yield image_np[..., ::-1]
+
+
+def detect_layouts(model: lp.Detectron2LayoutModel, page_images: list, batch_size: int = LAYOUT_BATCH_SIZE) -> list:
+    """
+    複数ページのレイアウトをまとめて検出する関数
+
+    `model.detect` は1ページずつ推論するため、Detectron2のモデルへ直接バッチで入力する
+
+    Args:
+        model (lp.Detectron2LayoutModel): レイアウト検出モデル
+        page_images (list): BGR形式のページ画像のリスト
+        batch_size (int): 一度に推論するページ数
+
+    Returns:
+        list: ページごとの検出結果(lp.Layout)のリスト
+    """
+    predictor = model.model
+    use_cuda = torch.cuda.is_available()
+    layouts = []
+    with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16, enabled=use_cuda):
+        for start in range(0, len(page_images), batch_size):
+            batched_inputs = []
+            for image_np in page_images[start:start + batch_size]:
+                # DefaultPredictor.__call__ と同じ前処理を行う
+                if predictor.input_format == "RGB":
+                    image_np = image_np[:, :, ::-1]
+                height, width = image_np.shape[:2]
+                image = predictor.aug.get_transform(image_np).apply_image(image_np)
+                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+                batched_inputs.append({"image": image, "height": height, "width": width})
+            outputs = predictor.model(batched_inputs)
+            layouts.extend(model.gather_output(output) for output in outputs)
+    return layouts
+
+
+def save_segment_image(segment_image: np.ndarray, image_path: str) -> None:
     """
-    PDFから図表を抽出する関数
+    切り出した画像をJPEGで保存する関数
 
     Args:
-        pdf_path (str): 図表を抽出するPDFファイルのパス
+        segment_image (np.ndarray): 切り出したBGR形式の画像
+        image_path (str): 画像を保存するパス
+    """
+    # ページ画像はRGBを反転したビューのため、切り出した範囲だけ連続した配列にする
+    segment_image = np.ascontiguousarray(segment_image)
+    _, buffer = cv2.imencode(".jpg", segment_image, SEGMENT_JPEG_PARAMS)
+    buffer.tofile(image_path)
+
+
+def extract_figures_and_tables(page_images: list, save_dir: str) -> list:
+    """
+    PDFのページ画像から図表を抽出する関数
+
+    Args:
+        page_images (list): render_pagesで変換したBGR形式のページ画像のリスト
         save_dir (str): 抽出した画像を保存するディレクトリのパス
 
     Returns:
         list: 抽出した図表の情報を格納したリスト
     """
-    model = lp.Detectron2LayoutModel(
-        "lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config",
-        extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.8],
-        label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"},
-    )
-
-    images = pdf2image.convert_from_path(pdf_path)
+    model = get_publaynet_model()
 
     figure_and_table_data = []
     os.makedirs(save_dir, exist_ok=True)
 
-    for i, image in enumerate(images):
-        image_np = np.array(image)
-        image_np = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-        layout = model.detect(image_np)
+    layouts = detect_layouts(model, page_images)
 
+    for i, (image_np, layout) in enumerate(zip(page_images, layouts)):
         for j, block in enumerate(layout):
             if block.type in ["Table", "Figure"]:
                 segment_image = block.pad(left=5, right=10, top=15, bottom=5).crop_image(
                     image_np
                 )
-                image_path = os.path.join(save_dir, f"page_{i}_block_{j}.jpg")
-                cv2.imwrite(
-                    image_path, segment_image, [int(cv2.IMWRITE_JPEG_QUALITY), 95]
-                )
-                with open(image_path, "rb") as f:
-                    base64_image = base64.b64encode(f.read()).decode("utf-8")
+                image_path = os.path.join(save_dir, f"figure_page_{i}_block_{j}.jpg")
+                save_segment_image(segment_image, image_path)
                 figure_and_table_data.append(
-                    {"path": image_path, "base64": base64_image, "type": block.type}
+                    {"path": image_path, "type": block.type}
                 )
 
     return figure_and_table_data
 
 
-def extract_formulas(pdf_path: str, save_dir: str) -> list:
+def extract_formulas(page_images: list, save_dir: str) -> list:
     """
-    PDFから数式を抽出する関数
+    PDFのページ画像から数式を抽出する関数
 
     Args:
-        pdf_path (str): 数式を抽出するPDFファイルのパス
+        page_images (list): render_pagesで変換したBGR形式のページ画像のリスト
         save_dir (str): 抽出した画像を保存するディレクトリのパス
 
     Returns:
         list: 抽出した数式の情報を格納したリスト
     """
-    model = lp.Detectron2LayoutModel(
-        "lp://MFD/faster_rcnn_R_50_FPN_3x/config",
-        extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.8],
-        label_map={1: "Equation"},
-    )
-
-    images = pdf2image.convert_from_path(pdf_path)
+    model = get_mfd_model()
 
     figure_and_table_data = []
     os.makedirs(save_dir, exist_ok=True)
 
-    for i, image in enumerate(images):
-        image_np = np.array(image)
-        image_np = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-        layout = model.detect(image_np)
+    layouts = detect_layouts(model, page_images)
 
+    for i, (image_np, layout) in enumerate(zip(page_images, layouts)):
         for j, block in enumerate(layout):
             if block.type in ["Equation"]:
                 segment_image = block.pad(left=5, right=5, top=5, bottom=5).crop_image(
                     image_np
                 )
-                image_path = os.path.join(save_dir, f"page_{i}_block_{j}.jpg")
-                cv2.imwrite(
-                    image_path, segment_image, [int(cv2.IMWRITE_JPEG_QUALITY), 95]
-                )
-                with open(image_path, "rb") as f:
-                    base64_image = base64.b64encode(f.read()).decode("utf-8")
+                image_path = os.path.join(save_dir, f"formula_page_{i}_block_{j}.jpg")
+                save_segment_image(segment_image, image_path)
                 figure_and_table_data.append(
-                    {"path": image_path, "base64": base64_image, "type": block.type}
+                    {"path": image_path, "type": block.type}
                 )
 
     return figure_and_table_data
 
 
-def pdf_to_base64(pdf_path: str) -> list:
+def extract_layout_data(pdf_path: str, save_dir: str, with_formulas: bool, with_figures: bool) -> tuple:
+    """
+    PDFから数式と図表を抽出する関数
+
+    2つのレイアウト検出モデルがGPUを取り合わないよう、同じスレッドで順に実行する
+
+    Args:
+        pdf_path (str): 数式・図表を抽出するPDFファイルのパス
+        save_dir (str): 抽出した画像を保存するディレクトリのパス
+        with_formulas (bool): 数式を抽出するかどうか
+        with_figures (bool): 図表を抽出するかどうか
+
+    Returns:
+        tuple: 抽出した数式の情報のリスト、抽出した図表の情報のリスト
+    """
+    if not with_formulas and not with_figures:
+        return [], []
+
+    # ページ画像は一度だけ生成し、数式・図表の各処理で共有する
+    page_images = list(render_pages(pdf_path))
+
+    if with_formulas:
+        formula_data = extract_formulas(page_images, save_dir)
+    else:
+        formula_data = []
+    if with_figures:
+        figures_and_tables_data = extract_figures_and_tables(page_images, save_dir)
+    else:
+        figures_and_tables_data = []
+
+    return formula_data, figures_and_tables_data
+
+
+def pdf_to_base64(pdf_path: str, dpi: int = 150):
     """
-    PDFをbase64エンコードされた画像のリストに変換する関数
+    PDFをページごとにbase64エンコードされた画像に変換するジェネレータ
+
+    ページのビットマップは1枚ずつ生成・破棄するため、同時に保持するのは1ページ分だけになる
+    ただし生成したbase64文字列は呼び出し側で全ページ分保持される
+
+    レイアウト検出用のページ画像(PDF_RENDER_DPI)とは解像度が異なるため、別にPDFから変換する
 
     Args:
         pdf_path (str): 変換するPDFファイルのパス
+        dpi (int): 変換する際の解像度
+
+    Yields:
+        str: base64エンコードされた画像
+    """
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=dpi)
+            yield base64.b64encode(pix.tobytes("jpeg")).decode("utf-8")
+
+
+async def call_with_retry(func, *args, **kwargs):
+    """
+    同期APIをスレッドで実行し、一時的なエラーは指数バックオフでリトライする関数
+
+    Args:
+        func (callable): 実行する同期関数
+        *args: funcに渡す位置引数
+        **kwargs: funcに渡すキーワード引数
 
     Returns:
-        list: base64エンコードされた画像のリスト
+        funcの戻り値
+    """
+    delay = 1.0
+    for attempt in range(LLM_MAX_RETRIES):
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES - 1:
+                raise
+            print(f'Retry {func.__name__} after {delay:.1f}s: {e}')
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay *= 2
+
+
+async def wait_for_file_processed(sample_file):
     """
-    images = pdf2image.convert_from_path(pdf_path)
+    アップロードしたファイルの処理完了を待つ関数
 
-    base64_images = []
+    `upload_file` は非同期的に実行されるため、完了を待たないと次の処理でエラーが発生してしまう
+    多くは1秒未満で完了するため、短い間隔から指数的に間隔を広げてポーリングする
 
-    for image in images:
-        buffered = BytesIO()
-        image.save(buffered, format="jpeg")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        base64_images.append(img_str)
+    Args:
+        sample_file: `genai.upload_file` の戻り値
 
-    return base64_images
+    Returns:
+        処理が完了したファイル
+    """
+    delay = 0.25
+    while sample_file.state.name == "PROCESSING":
+        print("Waiting for processed.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 5.0)
+        sample_file = await call_with_retry(genai.get_file, sample_file.name)
+    return sample_file
 
 
-def generate_image_explanation(image: str, pdf_text: str) -> str:
+async def generate_image_explanation(image: str, pdf_text: str) -> str:
     """
     画像の説明を生成する関数
 
     Args:
-        image (str): base64エンコードされた画像
+        image (str): 画像ファイルのパス
         pdf_text (str): 論文から抽出したテキスト
 
     Returns:
@@ -185,33 +513,26 @@ def generate_image_explanation(image: str, pdf_text: str) -> str:
     """
     start = datetime.now()
     print(f'generate_image_explanation {start}')
-    sample_file = genai.upload_file(path=image,
+    sample_file = await call_with_retry(genai.upload_file, path=image,
                            display_name="Figure of paper")
-    # アップロード完了をチェック
-    # `upload_file` は非同期的に実行されるため、完了を待たないと次の処理でエラーが発生してしまう
-    while sample_file.state.name == "PROCESSING":
-      print("Waiting for processed.")
-      time.sleep(5)
-      sample_file = genai.get_file(sample_file.name)
-    response = ai_client.generate_content([
+    sample_file = await wait_for_file_processed(sample_file)
+    response = await call_with_retry(ai_client.generate_content, [
                 f"論文から抽出したテキスト情報は以下です:\n{pdf_text}\n\n提供された論文の画像の示す意味を説明してください。",
                 "これは論文から抽出した画像です",
                 sample_file,
                 "説明はMarkdown形式かつ日本語で記述してください。",
                 ])
-    genai.delete_file(
-        sample_file
-    )
-    print(response)
+    await asyncio.to_thread(genai.delete_file, sample_file)
+    logger.debug("response: %s", response)
     return response.text
 
 
-def generate_formula_explanation(image: str, pdf_text: str) -> str:
+async def generate_formula_explanation(image: str, pdf_text: str) -> str:
     """
     数式の説明を生成する関数
 
     Args:
-        image (str): base64エンコードされた数式の画像
+        image (str): 数式の画像ファイルのパス
         pdf_text (str): 論文から抽出したテキスト
 
     Returns:
@@ -219,38 +540,67 @@ def generate_formula_explanation(image: str, pdf_text: str) -> str:
     """
     start = datetime.now()
     print(f'generate_formula_explanation {start}')
-    sample_file = genai.upload_file(path=image,
+    sample_file = await call_with_retry(genai.upload_file, path=image,
                            display_name="Formula of paper")
-    # アップロード完了をチェック
-    # `upload_file` は非同期的に実行されるため、完了を待たないと次の処理でエラーが発生してしまう
-    while sample_file.state.name == "PROCESSING":
-      print("Waiting for processed.")
-      time.sleep(5)
-      sample_file = genai.get_file(sample_file.name)
-    response = ai_client.generate_content([
+    sample_file = await wait_for_file_processed(sample_file)
+    response = await call_with_retry(ai_client.generate_content, [
                 f"あなたは優秀な研究者です。論文から抽出したテキスト情報は以下です:\n{pdf_text}\n\n提供された論文の数式部分の画像を提供するので、この数式の解説を行ってください",
                 "これは論文から抽出した画像です",
                 sample_file,
                 "数式はmarkdown内で使え、LaTeX の記法を用いて数式を記述することができるmathjaxを用い$$で囲んでください。解説はMarkdown形式かつ日本語で記述してください。Markdownは```で囲まないでください",
         ])
-    genai.delete_file(
-        sample_file
-    )
-    print(response)
+    await asyncio.to_thread(genai.delete_file, sample_file)
+    logger.debug("response: %s", response)
     return response.text
 
 
+async def generate_explanations(formula_data: list, figures_and_tables_data: list, pdf_text: str) -> tuple:
+    """
+    数式・図表の説明を並列に生成する関数
+
+    Args:
+        formula_data (list): 抽出した数式の情報を格納したリスト
+        figures_and_tables_data (list): 抽出した図表の情報を格納したリスト
+        pdf_text (str): 論文から抽出したテキスト
+
+    Returns:
+        tuple: 数式の説明のリスト、図表の説明のリスト
+    """
+    # レート制限を超えないよう同時実行数を制限する
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    text_hash = cache_key(pdf_text[:4096])
+
+    async def explain(generate, data):
+        # 同じ画像・論文の説明は再生成しない
+        image_hash = await asyncio.to_thread(file_sha256, data["path"])
+        key = cache_key(generate.__name__, image_hash, text_hash)
+        cached = await asyncio.to_thread(load_cache, key)
+        if cached is not None and "explanation" in cached:
+            return cached["explanation"]
+        async with semaphore:
+            explanation = await generate(data["path"], pdf_text)
+        await asyncio.to_thread(save_cache, key, {"explanation": explanation})
+        return explanation
+
+    tasks = [explain(generate_formula_explanation, data) for data in formula_data]
+    tasks += [explain(generate_image_explanation, data) for data in figures_and_tables_data]
+    results = await asyncio.gather(*tasks)
+    return results[:len(formula_data)], results[len(formula_data):]
+
+
 def generate_paper_summary_ochiai(images: list, arxiv_url: str) -> str:
     """
     落合メソッドで論文の要約を生成する関数
 
     Args:
-        images (list): base64エンコードされた論文の画像のリスト
+        images (iterable): base64エンコードされた論文の画像
         arxiv_url (str): 論文のarXivのURL
 
     Returns:
         str: 生成された論文の要約
     """
+    # トークン数の確認とリクエストの両方で使うため、base64文字列のみリストに保持する
+    images = list(images)
     token_count = ai_client.count_tokens(images)
     print(f'{token_count}')
     start = datetime.now()
@@ -281,7 +631,7 @@ f"論文URL: {arxiv_url}",
     end = datetime.now()
     print('Time:', end-start)
     print('ochiai_withimage:')
-    print(response)
+    logger.debug("response: %s", response)
     return response.text
 
 def generate_paper_summary_ochiai_text(pdf_text: str, arxiv_url: str) -> str:
@@ -289,21 +639,17 @@ def generate_paper_summary_ochiai_text(pdf_text: str, arxiv_url: str) -> str:
     落合メソッドで論文の要約を生成する関数
 
     Args:
-        pdf_text (str): 論文から抽出したテキスト
+        pdf_text (str): 論文から抽出し、Referencesの前までに切り詰めたテキスト
         arxiv_url (str): 論文のarXivのURL
 
     Returns:
         str: 生成された論文の要約
     """
-    # Referencesの前までを取り出す
-    pdf_text = get_text_before_word(pdf_text, 'References')
-    token_count = ai_client.count_tokens(pdf_text)
-    pdf_text = pdf_text[:truncate_len]
+    # ログ用のトークン数はAPIを呼ばずローカルで数える
     text_len = get_token_len(pdf_text)
-    token_count_trunc = ai_client.count_tokens(pdf_text)
     start = datetime.now()
     print(f'generate_paper_summary_ochiai_text {start}')
-    print(f'{token_count} -> {token_count_trunc}')
+    print(f'{text_len = }')
     response = ai_client.generate_content([
         """あなたは優秀な研究者です。提供された論文の画像を元に以下のフォーマットに従って論文の解説を行ってください。
 
@@ -336,48 +682,56 @@ f"""論文URL: {arxiv_url}
     end = datetime.now()
     print('Time:', end-start)
     print('ochiai_withtext:')
-    print(response)
+    logger.debug("response: %s", response)
     return response.text
 
 
-def generate_paper_summary_ochiai_text_formula(pdf_text: str, images: list, arxiv_url: str) -> str:
+async def generate_paper_summary_ochiai_text_formula(pdf_text: str, images: list, arxiv_url: str) -> str:
     """
     落合メソッドで論文の要約を生成する関数
 
     Args:
-        pdf_text (str): 論文から抽出したテキスト
+        pdf_text (str): 論文から抽出し、Referencesの前までに切り詰めたテキスト
+        images (list): 抽出した図表・数式の情報を格納したリスト
         arxiv_url (str): 論文のarXivのURL
 
     Returns:
         str: 生成された論文の要約
     """
-    # Referencesの前までを取り出す
-    pdf_text = get_text_before_word(pdf_text, 'References')
-    token_count = ai_client.count_tokens(pdf_text)
-    pdf_text = pdf_text[:truncate_len]
+    # ログ用のトークン数はAPIを呼ばずローカルで数える
     text_len = get_token_len(pdf_text)
-    token_count_trunc = ai_client.count_tokens(pdf_text)
     start = datetime.now()
     print(f'generate_paper_summary_ochiai_text {start}')
-    print(f'{token_count} -> {token_count_trunc}')
+    print(f'{text_len = }')
 
     # 画像の準備 ---
-    sample_files = []
-    file_names = []
-    for image_data in images:
-        # {"path": image_path, "base64": base64_image, "type": block.type}
-        sample_file = genai.upload_file(path=image_data['path'],
-                           display_name=os.path.basename(image_data['path']))
-    # アップロード完了をチェック
-    # `upload_file` は非同期的に実行されるため、完了を待たないと次の処理でエラーが発生してしまう
-    while sample_file.state.name == "PROCESSING":
-        print("Waiting for processed.")
-        time.sleep(5)
-    sample_files.append(genai.get_file(sample_file.name))
-    file_names.append(sample_file.name)
-    # ---
-
-    response = ai_client.generate_content([
+    # アップロードと処理完了の待機は画像ごとに並列に行う
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    # 途中で失敗しても削除できるよう、アップロードしたファイルはすべて記録する
+    uploaded_files = []
+
+    async def upload(image_data):
+        # {"path": image_path, "type": block.type}
+        async with semaphore:
+            sample_file = await call_with_retry(genai.upload_file, path=image_data['path'],
+                               display_name=os.path.basename(image_data['path']))
+            uploaded_files.append(sample_file)
+            return await wait_for_file_processed(sample_file)
+
+    try:
+        # 失敗したアップロードがあっても、他のアップロードが終わるのを待ってから削除する
+        results = await asyncio.gather(*[upload(image_data) for image_data in images], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        # 画像名とファイルを別々のパートとして渡し、画像そのものをGeminiに入力する
+        image_parts = []
+        for sample_file in results:
+            image_parts += [f'画像名: {sample_file.name}', sample_file]
+        # ---
+
+        response = await call_with_retry(ai_client.generate_content, [
         """あなたは優秀な研究者です。提供された論文の画像を元に以下のフォーマットに従って論文の解説を行ってください。
 
 # {論文タイトル}
@@ -407,16 +761,20 @@ f"""論文URL: {arxiv_url}
 {pdf_text}
 ---
 以下は論文から抽出した図、表、数式の画像です。必要であれば画像の情報を使って解説をしてください。また、この論文のキービジュアルを1枚選択し画像名を記入してください。""",
-*[f'画像名: {name}, 画像: {file}' for file, name in zip(sample_files, file_names)],
+*image_parts,
 """数式はmarkdown内で使え、LaTeX の記法を用いて数式を記述することができるmathjaxを用い$$で囲んでください。解説はMarkdown形式かつ日本語で記述してください。Markdownは```で囲まないでください"
 
 論文の解説はMarkdown形式かつ日本語で記述してください。""",
         ])
+    finally:
+        await asyncio.gather(
+            *[asyncio.to_thread(genai.delete_file, sample_file) for sample_file in uploaded_files],
+            return_exceptions=True,
+        )
     end = datetime.now()
     print('Time:', end-start)
-    genai.delete_file(sample_file)
     print('ochiai_withtext:')
-    print(response)
+    logger.debug("response: %s", response)
     return response.text
 
 
@@ -425,16 +783,12 @@ def generate_paper_summary_ochiai_text_local(pdf_text: str, arxiv_url: str) -> s
     落合メソッドで論文の要約を生成する関数
 
     Args:
-        pdf_text (str): 論文から抽出したテキスト
+        pdf_text (str): 論文から抽出し、Referencesの前までに切り詰めたテキスト
         arxiv_url (str): 論文のarXivのURL
 
     Returns:
         str: 生成された論文の要約
     """
-    # Referencesの前までを取り出す
-    pdf_text = get_text_before_word(pdf_text, 'References')
-    txet_len = get_token_len(pdf_text)
-    print(f'{txet_len = }')
     pdf_text = pdf_text[:10000]
     txet_len = get_token_len(pdf_text)
     print(f'{txet_len = }')
@@ -476,11 +830,67 @@ f"論文URL: {arxiv_url}"""},
     end = datetime.now()
     print('Time:', end-start)
     print('ochiai_withtext:')
-    print(response.choices[0].message.content)
+    logger.debug("response: %s", response.choices[0].message.content)
     return response.choices[0].message.content
 
 
-def paper_reader(arxiv_url: str, pdf_file, processing_mode: str, processing_mode_body: str, ) -> tuple:
+def gradio_file_url(path: str) -> str:
+    """
+    Gradioが配信するファイルのURLを返す関数
+
+    Gradio 4系の`/file=`のルートを使うため、requirements.txtでバージョンを固定している
+
+    Args:
+        path (str): 配信するファイルのパス
+
+    Returns:
+        str: 画面のMarkdownから参照するURL
+    """
+    return f"/file={os.path.abspath(path)}"
+
+
+def build_explanation_outputs(formula_items, figure_items) -> tuple:
+    """
+    画面に表示する数式・図表の説明とギャラリーのデータを作成する関数
+
+    Args:
+        formula_items (list): 数式の[画像のパス, 説明]のリスト。Noneの場合は説明を行っていない
+        figure_items (list): 図表の[画像のパス, 説明]のリスト。Noneの場合は図表の説明を含めない
+
+    Returns:
+        tuple: 数式・図表の説明のMarkdown、画像の説明のリスト
+    """
+    if formula_items is None:
+        return "", []
+    gallery_data = formula_items + (figure_items or [])
+    explaination_text = build_explanation_markdown(formula_items, figure_items, gradio_file_url)
+    return explaination_text, gallery_data
+
+
+def build_explanation_markdown(formula_items: list, figure_items, image_ref) -> str:
+    """
+    数式・図表の説明をMarkdownにまとめる関数
+
+    Args:
+        formula_items (list): 数式の[画像のパス, 説明]のリスト
+        figure_items (list): 図表の[画像のパス, 説明]のリスト。Noneの場合は図表の説明を含めない
+        image_ref (callable): 画像のパスをMarkdownから参照するパスに変換する関数
+
+    Returns:
+        str: 数式・図表の説明のMarkdown
+    """
+    # 文字列の連結を繰り返すとコピーが増えるため、リストに集めて最後に結合する
+    parts = ["# 数式の説明\n\n"]
+    for i, (path, explanation) in enumerate(formula_items):
+        parts.append(f"## 数式画像{i}\n\n![]({image_ref(path)})\n\n{explanation}\n\n")
+    if figure_items is not None:
+        parts.append("# 図表の説明\n\n")
+        for i, (path, explanation) in enumerate(figure_items):
+            parts.append(f"## 画像{i}\n\n![]({image_ref(path)})\n\n{explanation}\n\n")
+    return "".join(parts)
+
+
+async def paper_reader(arxiv_url: str, pdf_file, processing_mode: str, processing_mode_body: str, ) -> tuple:
     """
     論文を読み、要約と説明を生成する関数
 
@@ -498,68 +908,100 @@ def paper_reader(arxiv_url: str, pdf_file, processing_mode: str, processing_mode
         pdf_path = pdf_file
         pdf_name = pdf_path.split('/')[-1].split('.')[0]
     else:
-        pdf_path, pdf_name = download_paper(arxiv_url, save_dir_name)
+        pdf_path, pdf_name = await asyncio.to_thread(download_paper, arxiv_url, save_dir_name)
 
     print(f'Load PDF, {pdf_path = }')
 
-    if processing_mode == "all" or processing_mode == "text_formula":
-        print('Extract images start')
-        formula_data = extract_formulas(pdf_path, save_dir_name)
+    # 同じ論文・処理方式の結果があれば再利用する
+    # PDFのハッシュ計算やキャッシュの読み書きはイベントループを止めないようスレッドで行う
+    pdf_hash = await asyncio.to_thread(file_sha256, pdf_path)
+    result_key = cache_key(pdf_hash, processing_mode, processing_mode_body)
+    cached = await asyncio.to_thread(load_cache, result_key)
+    # 形式の異なる古いキャッシュは使わない
+    if cached is not None and "formula_items" in cached:
+        explaination_text, gallery_data = build_explanation_outputs(cached["formula_items"], cached["figure_items"])
+        # 参照している画像が削除されていない場合のみ使う
+        if all(os.path.exists(path) for path, _ in gallery_data):
+            print('Use cached result')
+            return pdf_file, cached["summary"], explaination_text, gallery_data, cached["pdf_text"]
+
+    with_formulas = processing_mode == "all" or processing_mode == "text_formula"
+    # 図表は解説対象になくてもGeminiのテキスト版の要約に添えるため抽出する
+    with_figures = processing_mode != "text_only" or processing_mode_body == "body_text-gemini"
+    if with_formulas or with_figures:
+        # 切り出した画像は出力するMarkdownから相対パスで参照するため、outputの下に保存する
+        # 同時に実行されたリクエストと画像が混ざらないよう、ディレクトリはリクエストごとに作成する
+        image_dir_name = tempfile.mkdtemp(dir=OUTPUT_DIR, prefix=f"images_{formatted_date}_")
     else:
-        formula_data = []
-    # 図表は解説対象になくても添えるため抽出する
-    figures_and_tables_data = extract_figures_and_tables(pdf_path, save_dir_name)
+        image_dir_name = None
+
+    # テキスト抽出とレイアウト検出は互いに独立しているため並列に実行する
+    print('Extract text and images start')
+    pdf_text, (formula_data, figures_and_tables_data) = await asyncio.gather(
+        asyncio.to_thread(extract_text, pdf_path),
+        asyncio.to_thread(extract_layout_data, pdf_path, image_dir_name, with_formulas, with_figures),
+    )
+
+    # Referencesの前までを取り出し、以降の要約・解説では切り詰めたテキストを使う
+    # 数式・図表の解説に渡す文脈や、画面に表示するテキストもこの切り詰めたものになる
+    pdf_text = get_text_before_word(pdf_text, 'References')[:truncate_len]
 
     print(f'Processing body start, {processing_mode_body = }')
 
     processing_body, llm_client = processing_mode_body.split('-')
 
-    if 'body_text' == processing_body:
-        pdf_text = extract_text(pdf_path)
-    elif 'body_image' == processing_body:
+    if 'body_image' == processing_body:
         images = pdf_to_base64(pdf_path)
-    else:
-        pass
 
     if 'gemini' == llm_client and 'body_text' == processing_body:
         # テキスト抽出版 geminiはテキスト版じゃないと制限引っかかる
-        paper_summary_ochiai = generate_paper_summary_ochiai_text_formula(pdf_text, figures_and_tables_data + formula_data, arxiv_url)
+        paper_summary_ochiai = await generate_paper_summary_ochiai_text_formula(pdf_text, figures_and_tables_data + formula_data, arxiv_url)
         # paper_summary_ochiai = generate_paper_summary_ochiai_text(pdf_text, arxiv_url)
     elif 'gemini' == llm_client and 'body_image' == processing_body:
-        paper_summary_ochiai = generate_paper_summary_ochiai(images, arxiv_url) # 画像版
+        paper_summary_ochiai = await asyncio.to_thread(generate_paper_summary_ochiai, images, arxiv_url) # 画像版
     else:
-        paper_summary_ochiai = generate_paper_summary_ochiai_text_local(pdf_text, arxiv_url)
+        paper_summary_ochiai = await asyncio.to_thread(generate_paper_summary_ochiai_text_local, pdf_text, arxiv_url)
     print(f'Processing body end, {processing_mode_body = }')
 
-    gallery_data = []
     if processing_mode == "text_only":
-        explaination_text = ""
+        formula_items = None
+        figure_items = None
+        explaination_file_text = ""
     else:
-        print('Processing formulas start')
-        explaination_text = "# 数式の説明\n\n"
-        for i, data in enumerate(formula_data):
-            # explanation = generate_formula_explanation(data["base64"], pdf_text)
-            explanation = generate_formula_explanation(data["path"], pdf_text)
-            gallery_data.append([data["path"], explanation])
-            explaination_text += f"## 数式画像{i}\n\n![](data:image/jpg;base64,{data['base64']})\n\n{explanation}\n\n"
-        print('Processing formulas end')
-        if processing_mode != "formula_only":
-            print('Processing figures_and_tables start')
-            explaination_text += "# 図表の説明\n\n"
-            for i, data in enumerate(figures_and_tables_data):
-                # explanation = generate_image_explanation(data["base64"], pdf_text)
-                explanation = generate_image_explanation(data["path"], pdf_text)
-                gallery_data.append([data["path"], explanation])
-                explaination_text += f"## 画像{i}\n\n![](data:image/jpg;base64,{data['base64']})\n\n{explanation}\n\n"
-            print('Processing figures_and_tables end')
-
-    with open(f'output/summary_{pdf_name}.md', 'w', encoding='utf-8') as f:
-        f.write(paper_summary_ochiai)
-    if explaination_text:
-        with open(f'output/explaination_{pdf_name}.md', 'w', encoding='utf-8') as f:
-            f.write(explaination_text)
-
-    return pdf_file, paper_summary_ochiai, explaination_text, gallery_data, pdf_text[:truncate_len]
+        print('Processing explanations start')
+        if processing_mode == "formula_only":
+            explained_figures = []
+        else:
+            explained_figures = figures_and_tables_data
+        formula_explanations, figure_explanations = await generate_explanations(
+            formula_data, explained_figures, pdf_text
+        )
+        print('Processing explanations end')
+        formula_items = [[data["path"], explanation] for data, explanation in zip(formula_data, formula_explanations)]
+        if processing_mode == "formula_only":
+            figure_items = None
+        else:
+            figure_items = [[data["path"], explanation] for data, explanation in zip(figures_and_tables_data, figure_explanations)]
+        # 画像はbase64で埋め込まず、保存済みのファイルを参照する
+        # 保存用は出力ディレクトリからの相対パスにする
+        explaination_file_text = build_explanation_markdown(
+            formula_items, figure_items, lambda path: os.path.relpath(path, OUTPUT_DIR)
+        )
+    explaination_text, gallery_data = build_explanation_outputs(formula_items, figure_items)
+
+    write_in_background(os.path.join(OUTPUT_DIR, f'summary_{pdf_name}.md'), paper_summary_ochiai)
+    if explaination_file_text:
+        write_in_background(os.path.join(OUTPUT_DIR, f'explaination_{pdf_name}.md'), explaination_file_text)
+
+    await asyncio.to_thread(save_cache, result_key, {
+        "summary": paper_summary_ochiai,
+        # 画面表示用のURLはGradioに依存するため、キャッシュには画像のパスを保存する
+        "formula_items": formula_items,
+        "figure_items": figure_items,
+        "pdf_text": pdf_text,
+    })
+
+    return pdf_file, paper_summary_ochiai, explaination_text, gallery_data, pdf_text
 
 
 # Blocksでappを定義